@@ -4,22 +4,23 @@ import numpy as np
 
 from enum import Enum, member
 from abc import ABC, abstractmethod
-from pathlib import PurePath
+from pathlib import Path, PurePath
 from tempfile import mkdtemp
-from typing import Any
-from functools import partial, reduce
+from typing import Any, Callable
+import math
+import shutil
+from functools import partial
 
 import logging
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger = logging.getLogger(__name__)
 
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 
 from pylatex.base_classes import LatexObject
 
-from .latex_string import LatexString, LatexStringTable, FigureContainer
+from .latex_string import LatexString, LatexStringTable, FigureContainer, longtable, table
 
 plt.ioff()
 
@@ -68,21 +69,30 @@ class EMDOptions(Options):
         """Changes Enum creation process so that each member.value points to the _emd_grouping method with their hard-coded interval_duration"""
         obj = object.__new__(cls)
         obj._value_ = partial(cls._emd_grouping, interval_duration=value)
+        obj.interval_duration = value
         return obj
 
     @classmethod
-    def _emd_grouping(cls, df: pd.DataFrame, interval_duration: float) -> pd.DataFrame:
-        """Sums counts by link and supplied interval duration"""
-        df["interval"] = df.apply(cls._interval, interval_duration=interval_duration, axis=1)
-        df = df.groupby(["link_id", "interval"])[["count_sim", "count_obs"]].sum().reset_index()
-        # print(df)
+    def _emd_grouping(
+        cls, df: pd.DataFrame, interval_duration: float, base_duration: int | None = None
+    ) -> pd.DataFrame:
+        """
+        Sums counts by link and supplied interval duration (intervals are identified by their integer quotient)
+
+        If base_duration is given, df must already be grouped by this function into intervals of base_duration (which must divide interval_duration), and those intervals are rolled up instead of re-binning the raw times
+        """
+        if base_duration is None:
+            interval = df["time"].to_numpy() // interval_duration
+        else:
+            interval = df["interval"].to_numpy() // (interval_duration // base_duration)
+        df = (
+            df.assign(interval=interval.astype(np.int64))
+            .groupby(["link_id", "interval"], sort=False, observed=True)[["count_sim", "count_obs"]]
+            .sum()
+            .reset_index()
+        )
         return df
 
-    @classmethod
-    def _interval(cls, row, interval_duration: float) -> str:
-        quotient = row["time"] // interval_duration
-        return f"[{quotient * interval_duration},{(quotient + 1) * interval_duration})"
-
 
 class Filter(ABC):
     """Abstract base class for filters"""
@@ -114,23 +124,27 @@ class FilterNothing(Filter):
 class FilterByValue(Filter):
     """
     Given a dictionary of dataframe columns and lists of values in those columns, returns a dataframe in which rows have the given values for the given columns
+
+    A tuple of columns may be used as a key, in which case its values are tuples that rows must match on all of those columns at once
     """
 
-    def __init__(self, rules: dict[str, list]) -> None:
+    def __init__(self, rules: dict[str | tuple[str, ...], list]) -> None:
         super().__init__(rules)
 
     def apply_filter(self, result: pd.DataFrame) -> pd.DataFrame:
-        if len(self.rules) > 1:
-            # Based it on Ben Saunders' answer at https://stackoverflow.com/questions/34157811/filter-a-pandas-dataframe-using-values-from-a-dict
-            return result.loc[
-                reduce(
-                    lambda left, right: result[left[0]].isin(left[1]) & result[right[0]].isin(right[1]),
-                    self.rules.items(),
-                ),
-                :,
-            ]
-        else:
-            return result[result[list(self.rules)[0]].isin(self.rules.values())]
+        # Apply the most selective rules first so that the remaining ones only scan the rows still left
+        for col, values in sorted(self.rules.items(), key=lambda rule: len(rule[1])):
+            result = result.loc[self._isin(result, col, values)]
+        return result
+
+    @staticmethod
+    def _isin(result: pd.DataFrame, col: str | tuple[str, ...], values: list) -> np.ndarray:
+        """Boolean mask of the rows whose value(s) in col are among values"""
+        if isinstance(col, tuple):
+            # Composite keys are matched on a MultiIndex rather than by building a tuple per row
+            keys = pd.MultiIndex.from_arrays([result[c].to_numpy() for c in col])
+            return keys.isin([tuple(value) for value in values])
+        return result[col].isin(values).to_numpy()
 
     def __str__(self) -> str:
         strings = ["Filter by value:"] + [f"\n\t{col}: {values}" for col, values in self.rules.items()]
@@ -164,9 +178,11 @@ class Analysis(ABC):
     def __init__(self, filter: Filter, options: Options = Options) -> None:
         self.filter = filter if filter is not None else FilterNothing()
         self.options = options
+        # Resolve the selected options once so analyses don't go through the Enum machinery on every call
+        self._functions: dict[str, Callable] = {member.name: member.value for member in options}
 
-        logging.info("%s", type(self))
-        logging.info("%s", self.options)
+        logger.debug("%s", type(self))
+        logger.debug("%s", self.options)
 
         return
 
@@ -174,6 +190,24 @@ class Analysis(ABC):
     def generate_analysis(self, comparison) -> None:
         pass
 
+    @staticmethod
+    def _prepare(comparison: pd.DataFrame) -> pd.DataFrame:
+        """
+        Downcasts the count and time columns to 32 bits, halving the memory traffic of the analyses that only sum counts
+
+        Counts are only downcast (to float32, so that squared differences can't overflow) when they are whole numbers whose absolute total is below 2**24, so that every sum of them is still exact in float32.
+        Other reductions (means, quantiles, ...) are not exact in float32, analyses using them must not call this
+        """
+        dtypes = {}
+        for col in comparison.columns.intersection(["count_sim", "count_obs"]):
+            values = comparison[col].to_numpy()
+            if np.abs(values).sum() < 2**24 and (values == np.round(values)).all():
+                dtypes[col] = np.float32
+        if "time" in comparison.columns and pd.api.types.is_integer_dtype(comparison["time"]):
+            if comparison["time"].between(np.iinfo(np.int32).min, np.iinfo(np.int32).max).all():
+                dtypes["time"] = np.int32
+        return comparison.astype(dtypes)
+
     def _save_result(self, result: pd.DataFrame):
         """Passes the generate_analysis result through the filter and assigns it as an instance attribute"""
         self.result = self.filter.apply_filter(result)
@@ -192,26 +226,26 @@ class CountComparison(Analysis):
         super().__init__(filter, options)
 
     def generate_analysis(self, comparison: pd.DataFrame) -> None:
-        result = comparison
-        for member in self.options:
-            result[member.name] = member.value(result)
-
-        cols = [member.name for member in self.options]
+        # The options get the whole comparison (with the columns of the options before them), as a shallow copy so that the
+        # caller's comparison is left untouched
+        result = comparison.copy(deep=False)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for name, function in self._functions.items():
+                result[name] = function(result)
+
+        # Rounded only once all options are computed, so that options using earlier ones get their unrounded values
+        cols = list(self._functions)
         result[cols] = result[cols].round(2)
 
         self._save_result(result)
 
     def to_latex(self, **kwargs) -> LatexObject:
-        styler = self.result.set_index("link_id").select_dtypes(include=np.number).sort_index().style
-        styler.format(escape="latex", precision=2)
+        table = self.result.set_index("link_id").select_dtypes(include=np.number)
+        # The comparison normally comes out of a sorted groupby already, in which case the copy made by sort_index is skipped
+        if not table.index.is_monotonic_increasing:
+            table = table.sort_index()
         return LatexStringTable(
-            styler.to_latex(
-                caption="Link by link comparison of traffic counts",
-                position="H",
-                label="table:link-count",
-                environment="longtable",
-            ),
-            ["_"],
+            longtable(table, caption="Link by link comparison of traffic counts", label="table:link-count"), ["_"]
         )
 
 
@@ -224,25 +258,17 @@ class CountSummaryStats(Analysis):
         super().__init__(filter, options)
 
     def generate_analysis(self, comparison: pd.DataFrame) -> None:
-        result = pd.DataFrame(
-            index=[stat.name for stat in self.options], columns=comparison.select_dtypes(include=np.number).columns
-        ).drop(columns=["link_id"])
-        for column in result.columns:
-            for stat in self.options:
-                result.loc[stat.name, column] = stat.value(comparison[column])
-        self._save_result(result.astype(float).round(2))
+        # Not downcast with _prepare: means and quantiles of float32 counts differ from the float64 ones
+        numeric = comparison.select_dtypes(include=np.number).drop(columns=["link_id"])
+        # Each stat reduces every column at once, filling one row of the result
+        result = np.empty((len(self._functions), len(numeric.columns)), dtype=np.float64)
+        for row, function in zip(result, self._functions.values()):
+            row[:] = function(numeric)
+        self._save_result(pd.DataFrame(result, index=list(self._functions), columns=numeric.columns).round(2))
 
     def to_latex(self, **kwargs) -> LatexObject:
-        styler = self.result.style
-        styler.format(escape="latex", precision=2)
         return LatexStringTable(
-            styler.to_latex(
-                caption="Summary statistics for traffic counts",
-                position="H",
-                label="table:summary-stats",
-                position_float="centering",
-            ),
-            ["_"],
+            table(self.result, caption="Summary statistics for traffic counts", label="table:summary-stats"), ["_"]
         )
 
 
@@ -253,33 +279,82 @@ class CountVisualization(Analysis):
 
     def __init__(self, filter: Filter = None, options: Options = CountComparisonOptions) -> None:
         super().__init__(filter, options)
-
-    def generate_analysis(self, comparison: gpd.GeoDataFrame, **kwargs) -> None:
-        result: dict[str, Figure] = {}
-        for col in comparison.columns.difference(["geometry"]):
-            print(col)
-            fig, ax = plt.subplots()
-            comparison.plot(column=col, ax=ax, legend=True)
+        self._temp_directory: PurePath = None
+
+    def generate_analysis(
+        self,
+        comparison: gpd.GeoDataFrame,
+        directory: PurePath = None,
+        extension: str = "pdf",
+        rasterized: bool = True,
+        **kwargs,
+    ) -> None:
+        """Plots every column and saves the plots to directory (a temporary one, reused by later calls, by default)"""
+        # The simplified comparison is kept so that to_file can render the plots again in another format
+        self._simplified = self._simplify(comparison)
+        self._rasterized = rasterized
+        self._save_result(self._render(directory, extension))
+
+    def _render(self, directory: PurePath, extension: str) -> dict[str, PurePath]:
+        """
+        Plots every column of the simplified comparison and saves the plots to directory with the given extension
+
+        A single Figure, kept out of pyplot's registry, is reused for all columns so only one plot is held in memory at a time
+        """
+        if directory is None:
+            if self._temp_directory is None:
+                self._temp_directory = PurePath(mkdtemp())
+            directory = self._temp_directory
+        result: dict[str, PurePath] = {}
+        fig = Figure()
+        # Unlike Index.difference, dropping keeps the columns (and thus the plots) in their original order
+        for col in self._simplified.columns.drop(self._simplified.geometry.name):
+            logger.debug("Plotting %s", col)
+            # Clearing the whole figure (not just the axes) also drops the previous column's colorbar
+            fig.clear()
+            ax = fig.add_subplot()
+            self._simplified.plot(column=col, ax=ax, legend=True, rasterized=self._rasterized)
             ax.set_title(f"{col}")
             ax.axis("off")
             ax.set_frame_on(True)
-            result[col] = fig
+            result[col] = PurePath(directory, f"{col}.{extension}")
+            # bbox_inches=None so a global savefig.bbox="tight" doesn't trigger an extra draw of every plot
+            fig.savefig(result[col], dpi=fig.dpi, bbox_inches=None)
+        return result
 
-        self._save_result(result)
+    @staticmethod
+    def _simplify(comparison: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """Simplifies the geometries down to roughly the size of a figure pixel, as finer detail can't be seen in the plots"""
+        minx, miny, maxx, maxy = comparison.total_bounds
+        pixels = plt.rcParams["figure.figsize"][0] * plt.rcParams["figure.dpi"]
+        tolerance = max(maxx - minx, maxy - miny) / pixels
+        return comparison.assign(geometry=comparison.geometry.simplify(tolerance, preserve_topology=False))
 
     def to_latex(self, **kwargs) -> LatexObject:
         paths = self.to_file(**kwargs)
-        print(f"Paths: {paths}")
+        logger.debug("Paths: %s", paths)
         return FigureContainer(paths)
 
-    def to_file(self, directory: PurePath = None, extension: str = "pdf", **kwargs) -> list[PurePath]:
-        if directory is None:
-            directory = PurePath(mkdtemp())
-        paths: list[PurePath] = []
-        for title, plot in self.result.items():
-            filepath = PurePath(directory, f"{title}.{extension}")
-            plot.savefig(filepath)
-            paths.append(filepath)
+    def to_file(self, directory: PurePath = None, extension: str = None, **kwargs) -> list[PurePath]:
+        """
+        Returns the paths of the saved plots, copying them to directory first if one is given
+
+        The plots are rendered again (and kept as the result) if an extension other than the saved one is asked for
+        """
+        paths: list[PurePath] = list(self.result.values())
+        if extension is not None and any(path.suffix != f".{extension}" for path in paths):
+            self.result = self._render(directory, extension)
+            return list(self.result.values())
+        if directory is not None:
+            # Plots already saved in directory (e.g. the one given to generate_analysis) can't be copied onto themselves
+            paths = [
+                (
+                    path
+                    if Path(path).parent.resolve() == Path(directory).resolve()
+                    else PurePath(shutil.copy(path, directory))
+                )
+                for path in paths
+            ]
         return paths
 
 
@@ -294,34 +369,64 @@ class EarthMoverDistance(Analysis):
         super().__init__(filter, options)
 
     def generate_analysis(self, comparison: pd.DataFrame) -> None:
-        result = comparison.sort_values(by="link_id", ascending=True)
-
-        dataframes: list[pd.DataFrame] = []
-
-        for member in self.options:
-            dataframes.append(member.value(result).groupby("link_id").apply(self._vector_wasser).rename(member.name))
+        # Only the columns used below are taken so that no other (e.g. geometry) column is carried through the groupbys
+        result = self._prepare(comparison[["link_id", "time", "count_sim", "count_obs"]])
+        # Group on integer codes instead of hashing the link ids in every groupby, the ids are put back at the end
+        codes, link_ids = pd.factorize(result["link_id"], sort=True)
+        result = result.assign(link_id=codes)
+        # Missing link ids get code -1, which can't be binned, so their rows are dropped like a groupby on link_id would
+        if (codes < 0).any():
+            result = result[codes >= 0]
+
+        series: dict[str, pd.Series] = {}
+        # Only options built like EMDOptions have an interval_duration, any other option is called on the comparison as is
+        durations = {member.name: getattr(member, "interval_duration", None) for member in self.options}
+        if durations and all(isinstance(duration, int) and duration > 0 for duration in durations.values()):
+            # Bin the counts once at the finest resolution shared by all interval durations, coarser ones are rolled up
+            # from it, shortest first so that each one comes from the coarsest grouping already computed that divides it
+            base_duration = math.gcd(*durations.values())
+            groupings = {base_duration: EMDOptions._emd_grouping(result, base_duration)}
+            for name in sorted(durations, key=durations.get):
+                duration = durations[name]
+                if duration not in groupings:
+                    base = max(d for d in groupings if duration % d == 0)
+                    groupings[duration] = self._functions[name](groupings[base], base_duration=base)
+                series[name] = self._vector_wasser(groupings[duration], len(link_ids))
+        else:
+            for name, function in self._functions.items():
+                series[name] = self._vector_wasser(function(result), len(link_ids))
 
-        result = result["link_id"].drop_duplicates()
-        result = reduce(lambda left, right: pd.merge(left, right, on=["link_id"], how="outer"), [result] + dataframes)
+        # Only the input is downcast, the (links x options) result keeps full precision. link_id is kept as a column,
+        # like the other analyses results, so that it can be filtered on
+        result = pd.DataFrame(
+            {"link_id": link_ids, **{name: series[name].to_numpy(dtype=np.float64) for name in self._functions}}
+        )
 
         self._save_result(result)
 
-    def _vector_wasser(self, group) -> float:
-        return (
-            (group["count_sim"] / (group["count_sim"].sum()) - group["count_obs"] / (group["count_obs"].sum()))
-            .abs()
-            .sum()
-        )
+    @staticmethod
+    def _vector_wasser(grouped: pd.DataFrame, n_links: int) -> pd.Series:
+        """
+        Sums, for each link, the absolute difference between the normalized simulated and observed counts
+
+        grouped["link_id"] must hold integer link codes in [0, n_links), the result is indexed by those codes
+        """
+        codes = grouped["link_id"].to_numpy()
+        sim = grouped["count_sim"].to_numpy(dtype=np.float64)
+        obs = grouped["count_obs"].to_numpy(dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            diff = np.abs(
+                sim / np.bincount(codes, weights=sim, minlength=n_links)[codes]
+                - obs / np.bincount(codes, weights=obs, minlength=n_links)[codes]
+            )
+        # Links without any count are skipped like a pandas sum would (NaN contributes nothing)
+        diff[np.isnan(diff)] = 0
+        return pd.Series(np.bincount(codes, weights=diff, minlength=n_links))
 
     def to_latex(self, **kwargs) -> LatexObject:
-        styler = self.result.set_index("link_id").style
-        styler.format(escape="latex", precision=2)
         return LatexStringTable(
-            styler.to_latex(
-                caption="Traffic counts Earth Mover's Distance",
-                position="H",
-                label="table:emd",
-                environment="longtable",
+            longtable(
+                self.result.set_index("link_id"), caption="Traffic counts Earth Mover's Distance", label="table:emd"
             ),
             ["_"],
         )
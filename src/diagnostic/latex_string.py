@@ -1,7 +1,14 @@
-from pylatex.base_classes import LatexObject, Container
-from pylatex.utils import NoEscape
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+
+from pylatex.base_classes import LatexObject
+from pylatex.utils import NoEscape, fix_filename
 from pylatex.package import Package
-from pylatex import Figure
+
+logger = logging.getLogger(__name__)
 
 
 class LatexString(LatexObject):
@@ -9,7 +16,7 @@ class LatexString(LatexObject):
 
     def __init__(self, latex_string: str, escape: list[str], *args, **kwargs):
         if escape:
-            print(f"Escape chars: {escape}")
+            logger.debug("Escape chars: %s", escape)
             latex_string = self.escape(latex_string, escape)
         self.latex_string = latex_string
         super().__init__(*args, **kwargs)
@@ -18,10 +25,12 @@ class LatexString(LatexObject):
         return self.latex_string
 
     def escape(self, string: str, escape_chars: list[str]) -> str:
-        for char in escape_chars:
-            replacement = "\\" + char
-            string = string.replace(char, replacement)
-        return string
+        # A single regex pass escapes every sequence at once, instead of re-scanning the string for each one, so that no
+        # escape is escaped again by a later one. Longer sequences come first so they win over their own prefixes
+        sequences = sorted((char for char in escape_chars if char), key=len, reverse=True)
+        if not sequences:
+            return string
+        return re.sub("|".join(map(re.escape, sequences)), lambda match: "\\" + match.group(), string)
 
 
 class LatexStringTable(LatexString):
@@ -33,15 +42,89 @@ class LatexStringTable(LatexString):
         super().__init__(latex_string, escape, *args, **kwargs)
 
 
-class FigureContainer(Container):
-    """Container for images"""
+class FigureContainer(LatexObject):
+    """Holds one figure per image path, producing the same latex as a Container of pylatex Figures with add_image but formatted straight to a string"""
+
+    packages = [Package("graphicx")]
 
-    def __init__(self, paths, *, data=None, width=NoEscape(r"\textwidth"), position="H"):
-        data = [Figure(position=position) for path in paths]
-        for fig, path in zip(data, paths):
-            fig.add_image(str(path), width=width)
-        print(f"Data: {data}\nWidth: {width}")
-        super().__init__(data=data)
+    def __init__(self, paths, *, width=NoEscape(r"\textwidth"), position="H"):
+        figures = [
+            "\n\n"
+            rf"\begin{{figure}}[{position}]%"
+            "\n"
+            r"\centering%"
+            "\n"
+            rf"\includegraphics[width={width}]{{{fix_filename(str(path))}}}%"
+            "\n"
+            r"\end{figure}"
+            "\n\n"
+            for path in paths
+        ]
+        logger.debug("Figures: %s\nWidth: %s", figures, width)
+        self.latex_string = NoEscape("%\n".join(figures))
+        super().__init__()
 
     def dumps(self):
-        return self.dumps_content()
+        return self.latex_string
+
+
+def _tabular(df: pd.DataFrame, precision: int) -> tuple[str, list[str], list[str]]:
+    """
+    Returns the column format, header lines and body lines of df as the Styler would render them after Styler.format(precision=precision)
+
+    The cells are formatted a whole column at a time, which avoids the Styler's per-cell rendering that dominates report generation for tables with thousands of links
+    """
+    header = [" & ".join(["", *map(str, df.columns)]) + r" \\"]
+    if df.index.name is not None:
+        header.append(" & ".join([str(df.index.name), *[""] * len(df.columns)]) + r" \\")
+    column_format = "l" + "".join("r" if pd.api.types.is_numeric_dtype(dtype) else "l" for dtype in df.dtypes)
+
+    cells = [df.index.astype(str).to_numpy()]
+    for col in df.columns:
+        values = df[col].to_numpy()
+        if pd.api.types.is_float_dtype(values):
+            cells.append(np.char.mod(f"%.{precision}f", values))
+        else:
+            cells.append(values.astype(str))
+    rows = [" & ".join(row) + r" \\" for row in zip(*cells)]
+
+    return column_format, header, rows
+
+
+def longtable(df: pd.DataFrame, caption: str, label: str, position: str = "H", precision: int = 2) -> str:
+    """Renders a numeric DataFrame as a LaTeX longtable, producing the same output as Styler.to_latex(environment="longtable") after Styler.format(precision=precision)"""
+    column_format, header, rows = _tabular(df, precision)
+    lines = [
+        rf"\begin{{longtable}}[{position}]{{{column_format}}}",
+        rf"\caption{{{caption}}} \label{{{label}}} \\",
+        *header,
+        r"\endfirsthead",
+        rf"\caption[]{{{caption}}} \\",
+        *header,
+        r"\endhead",
+        rf"\multicolumn{{{len(df.columns) + 1}}}{{r}}{{Continued on next page}} \\",
+        r"\endfoot",
+        r"\endlastfoot",
+        *rows,
+        r"\end{longtable}",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+def table(df: pd.DataFrame, caption: str, label: str, position: str = "H", precision: int = 2) -> str:
+    """Renders a numeric DataFrame as a centered LaTeX table, producing the same output as Styler.to_latex(position_float="centering") after Styler.format(precision=precision)"""
+    column_format, header, rows = _tabular(df, precision)
+    lines = [
+        rf"\begin{{table}}[{position}]",
+        r"\centering",
+        rf"\caption{{{caption}}}",
+        rf"\label{{{label}}}",
+        rf"\begin{{tabular}}{{{column_format}}}",
+        *header,
+        *rows,
+        r"\end{tabular}",
+        r"\end{table}",
+        "",
+    ]
+    return "\n".join(lines)
@@ -1,12 +1,16 @@
+import logging
 from pathlib import PurePath
-from typing import Any
+from typing import Any, Callable
 
+import numpy as np
 import pandas as pd
 from geopandas import GeoDataFrame
 from pylatex import Document, Section
 
 from diagnostic.analyses import Analysis, CountComparison, CountSummaryStats, CountVisualization, EarthMoverDistance
 
+logger = logging.getLogger(__name__)
+
 
 class CreateComparisonDF:
     """Provides default methods for converting simulated + observed DataFrames to comparison DF to be used for Analysis objects"""
@@ -17,15 +21,19 @@ class CreateComparisonDF:
             observed.columns
         )
 
+        # Only links with observed counts make it through the inner merge below, so the (typically much larger) simulated side is cut down to them first
+        simulated = simulated.loc[simulated["link_id"].isin(observed["link_id"]).to_numpy()]
+
         if "time" in simulated.columns:
-            sim = simulated[["link_id", "count"]].groupby(["link_id"]).sum().reset_index()
+            # Sorted by link_id, which sets the row order of the comparison (the inner merge below follows the left keys)
+            sim = simulated[["link_id", "count"]].groupby("link_id", sort=True).sum().reset_index()
             if "geometry" in simulated.columns:
                 sim = GeoDataFrame(sim.merge(simulated[["link_id", "geometry"]].drop_duplicates(), on="link_id"))
         else:
-            sim = simulated.copy()
+            sim = simulated
 
         if "time" in observed.columns:
-            obs = observed[["link_id", "count"]].groupby(["link_id"]).sum().reset_index()
+            obs = observed[["link_id", "count"]].groupby("link_id", sort=True).sum().reset_index()
         else:
             obs = observed.copy()
 
@@ -38,10 +46,52 @@ class CreateComparisonDF:
             obs.columns
         )
 
-        sim = sim[["link_id", "time", "count"]].groupby(["link_id", "time"])["count"].sum().reset_index()
-        obs = obs[["link_id", "time", "count"]].groupby(["link_id", "time"])["count"].sum().reset_index()
+        # Both sides are stacked and summed together, so that their (link_id, time) keys are factorized into one shared code space and the outer join (with 0 for the missing side) falls out of the aggregation
+        both = pd.concat(
+            [
+                sim[["link_id", "time"]].assign(count_sim=sim["count"], count_obs=0),
+                obs[["link_id", "time"]].assign(count_sim=0, count_obs=obs["count"]),
+            ],
+            ignore_index=True,
+        )
+        return CreateComparisonDF._sum_counts(both, ["link_id", "time"], ["count_sim", "count_obs"])
 
-        return sim.merge(obs, on=["link_id", "time"], how="outer", suffixes=["_sim", "_obs"]).fillna(0)
+    @staticmethod
+    def _sum_counts(df: pd.DataFrame, keys: list[str], columns: tuple[str, ...] = ("count",)) -> pd.DataFrame:
+        """
+        Sums the given (count) columns of df by keys, giving the same (key-sorted) result as df.groupby(keys)[list(columns)].sum().reset_index()
+
+        The keys are factorized into one integer code per row, so that a single stable sort followed by np.add.reduceat over the sorted segments replaces the hash aggregation.
+        This only pays off on multiple keys (as in emd), a plain groupby is faster on a single one
+        """
+        codes = np.zeros(len(df), dtype=np.int64)
+        valid = np.ones(len(df), dtype=bool)
+        uniques = []
+        for key in keys:
+            key_codes, key_uniques = pd.factorize(df[key], sort=True)
+            # Missing keys get code -1 and are dropped, like groupby does
+            valid &= key_codes >= 0
+            codes = codes * len(key_uniques) + key_codes
+            uniques.append(key_uniques)
+
+        codes = codes[valid]
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        starts = np.flatnonzero(np.diff(codes, prepend=-1))
+
+        result = {}
+        group = codes[starts]
+        for key, key_uniques in zip(reversed(keys), reversed(uniques)):
+            group, key_codes = np.divmod(group, len(key_uniques))
+            result[key] = key_uniques.take(key_codes)
+        result = {key: result[key] for key in keys}
+
+        for col in columns:
+            counts = df[col].to_numpy()[valid][order]
+            if np.issubdtype(counts.dtype, np.floating):
+                counts = np.nan_to_num(counts, nan=0)
+            result[col] = np.add.reduceat(counts, starts) if len(starts) else counts
+        return pd.DataFrame(result)
 
 
 class CCDFMapper:
@@ -55,6 +105,21 @@ class CCDFMapper:
     }
 
 
+class ComparisonCache:
+    """Lazily creates the comparison DataFrames for a pair of simulated + observed DataFrames, computing each one only once however many analyses use it"""
+
+    def __init__(self, simulated: pd.DataFrame, observed: pd.DataFrame) -> None:
+        self.simulated = simulated
+        self.observed = observed
+        self._comparisons: dict[Callable, pd.DataFrame] = {}
+
+    def get(self, create_comparison: Callable) -> pd.DataFrame:
+        if create_comparison not in self._comparisons:
+            self._comparisons[create_comparison] = create_comparison(self.simulated, self.observed)
+        # Shallow copy so that analyses adding columns to their comparison don't alter the cached one
+        return self._comparisons[create_comparison].copy(deep=False)
+
+
 class Report:
     """Helper class to automatically run given analyses and generate integrated latex document"""
 
@@ -79,12 +144,13 @@ class Report:
         ATTENTION: This implementation requires that, should one wish for analysis1 to use the result from analysis2, then analysis2 must be before analysis1 in the passed-in analyses list
         """
         generated: list[Analysis] = []
+        comparisons = ComparisonCache(simulated, observed)
         for analysis in self.analyses:
-            print(f"Analysis:{analysis}")
+            logger.debug("Analysis: %s", analysis)
             if analysis in self.add and self.add.get(analysis) in generated:
                 analysis.generate_analysis(self.add[analysis].result)
             else:
-                comp = CCDFMapper.mapping[type(analysis)](simulated, observed)
+                comp = comparisons.get(CCDFMapper.mapping[type(analysis)])
                 analysis.generate_analysis(comp)
             generated.append(analysis)
 
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+import numpy as np
 import shapely as shp
 from enum import Enum, auto
 
@@ -28,3 +29,34 @@ class FullInfo:
 class FlowOrientation(Enum):
     ALONG = auto()
     COUNTER = auto()
+
+
+@dataclass
+class FlowSlots:
+    """Detector assigned to each link (by row position) for one flow orientation, -1 where there is none"""
+
+    detector: np.ndarray
+    distance: np.ndarray
+    degree: np.ndarray
+
+    @classmethod
+    def empty(cls, n_links: int) -> "FlowSlots":
+        return cls(np.full(n_links, -1, np.int32), np.full(n_links, np.inf), np.zeros(n_links, np.int32))
+
+
+@dataclass
+class MatchState:
+    """Network columns read during matching as plain arrays, indexed by link row position"""
+
+    detectors: list
+    geometry: np.ndarray
+    oneway: np.ndarray
+    # Link end nodes as their IDs and (n, 2) coordinates, the Node objects stay in the network
+    from_id: np.ndarray
+    to_id: np.ndarray
+    from_xy: np.ndarray
+    to_xy: np.ndarray
+    name_index: dict
+    slots: dict[FlowOrientation, FlowSlots]
+    # Ranked candidate links (and their end nodes' squared distances to the direction) of the detectors seen so far
+    candidates: dict[int, tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]
@@ -1,14 +1,16 @@
+from __future__ import annotations
+
 import logging
+from typing import TYPE_CHECKING
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
 import click
 
-import geopandas as gpd
-
-from map_matching.match_detector_osm import iterate, export_to_csv, prep_network, get_osm_net, perform_sanity_checks
-from map_matching.classes import FlowOrientation
+# The geospatial stack is only imported by the commands that run, so that --help and usage errors don't pay for it
+if TYPE_CHECKING:
+    import geopandas as gpd
 
 
 @click.group()
@@ -30,6 +32,11 @@ def cli(
     to_csv,
     sanity_checks,
 ):
+    import geopandas as gpd
+
+    # pyogrio reads and writes whole columns instead of one record at a time like fiona
+    gpd.options.io_engine = "pyogrio"
+
     detectors: gpd.GeoDataFrame = gpd.read_file(detectors_filename).set_crs(epsg=2056)
 
     logging.info("Read detectors")
@@ -43,7 +50,7 @@ def cli(
         detectors = detectors.merge(geocoded, on=direction_col).rename(
             {"geometry_x": "geometry", "geometry_y": "direction_coordinates"}, axis=1
         )
-        detectors = detectors[detectors["direction_coordinates"] != None]
+        detectors = detectors[detectors["direction_coordinates"].notna()]
 
         logging.info("Merged dfs")
 
@@ -60,32 +67,45 @@ def cli(
 @cli.result_callback()
 @click.pass_obj
 def process(detectors: gpd.GeoDataFrame, network: gpd.GeoDataFrame, output_filename, to_csv, sanity_checks, **kwargs):
-    print(detectors)
-    print(network)
+    import numpy as np
+    import pandas as pd
+    import geopandas as gpd
+
+    from map_matching.match_detector_osm import iterate, export_to_csv, perform_sanity_checks
+    from map_matching.classes import FlowOrientation
+
+    # Only the sizes, the repr of whole (Geo)DataFrames is expensive
+    logging.debug("Detectors: %d rows, network: %d rows", len(detectors), len(network))
 
     # TEMPORARY
-    network = network[network["name"].apply(lambda x: isinstance(x, str))]
+    # A string column only needs a null check, object ones (e.g. OSM ways with several names given as a list) need the type check
+    if isinstance(network["name"].dtype, pd.StringDtype):
+        network = network[network["name"].notna()]
+    else:
+        network = network[network["name"].map(type).eq(str)]
 
     network = iterate(detectors, network)
 
     if sanity_checks:
         print("Passed sanity checks") if perform_sanity_checks(network) else print("Failed sanity checks")
 
+    # The matching needs the full FullInfo objects, only the detector IDs are exported
+    # Only the (few) assigned links need a Python-level lookup, the rest stay None
     for flow in FlowOrientation:
-        network.loc[:, flow.name] = network[flow.name].apply(lambda x: x if x is None else x.detector.ID)
+        infos = network[flow.name].to_numpy()
+        assigned = pd.notna(infos)
+        ids = np.full(len(infos), None, dtype=object)
+        ids[assigned] = [info.detector.ID for info in infos[assigned]]
+        network.loc[:, flow.name] = ids
 
     if False:
-        filtered = network[~network[FlowOrientation.COUNTER.name].isna() | ~network[FlowOrientation.ALONG.name].isna()]
+        filtered = network[network[[flow.name for flow in FlowOrientation]].notna().any(axis=1)]
         filtered.drop(columns=["node_from", "node_to"]).to_file("filtered.shp")
-        nodes = (
-            pd.concat([filtered["node_from"], filtered["node_to"]])
-            .reset_index()
-            .drop(columns=["u", "v", "key"])
-            .assign(osmid=lambda x: x.apply(lambda y: y.iloc[0].ID, axis=1))
-            .assign(geometry=lambda x: x.apply(lambda y: y.iloc[0].geometry, axis=1))
-        )
+        nodes = pd.concat([filtered["node_from"], filtered["node_to"]]).to_numpy()
         # .drop_duplicates()\
-        gpd.GeoDataFrame(nodes).drop(columns=[0]).to_file("nodes.shp")
+        gpd.GeoDataFrame({"osmid": [node.ID for node in nodes], "geometry": [node.geometry for node in nodes]}).to_file(
+            "nodes.shp"
+        )
 
     network.drop(columns=["node_from", "node_to", "osmid"]).to_file(output_filename)
 
@@ -98,6 +118,8 @@ def process(detectors: gpd.GeoDataFrame, network: gpd.GeoDataFrame, output_filen
 @click.option("--from-bbox")
 @click.option("--save-net", nargs=2, default=None, type=click.Path())
 def from_osm(from_place, from_bbox, save_net):
+    from map_matching.match_detector_osm import get_osm_net, prep_network
+
     if from_place:
         nodes, links = get_osm_net(from_place)
     if save_net is not None:
@@ -114,10 +136,15 @@ def from_osm(from_place, from_bbox, save_net):
 @click.argument("nodes-filename", type=click.Path(exists=True))
 @click.argument("links-filename", type=click.Path(exists=True))
 def from_file(nodes_filename, links_filename):
+    import geopandas as gpd
+
+    from map_matching.match_detector_osm import prep_network
+
     nodes = gpd.read_file(nodes_filename)
     logging.info("Read nodes")
 
-    links = gpd.read_file(links_filename)
+    # Links without a name can't be matched to a detector's axis, so they aren't even read
+    links = gpd.read_file(links_filename, where="name IS NOT NULL")
     logging.info("Read links")
 
     return prep_network(nodes, links)
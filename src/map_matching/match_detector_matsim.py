@@ -1,13 +1,20 @@
 import json
+import logging
 import click
 
 import pandas as pd
 import geopandas as gpd
 import shapely as shp
-from fiona.errors import DriverError
+from pyogrio.errors import DataSourceError
 
 import matsim
 
+# pyogrio reads and writes whole columns (instead of one record at a time like fiona), DataSourceError above is its error type
+gpd.options.io_engine = "pyogrio"
+
+# Directions given relative to the city ("outwards"/"inwards") which can't be geocoded
+RELATIVE_DIRECTIONS = frozenset(["auswärts", "einwärts"])
+
 
 def get_coordinates_geopy(
     directions: pd.DataFrame, col_name: str = "Richtung", city: str = "Zurich"
@@ -17,32 +24,56 @@ def get_coordinates_geopy(
     )
 
 
-def closest_link(row, network: gpd.GeoDataFrame, net_name_col: str = "osm:way:name", detect_name_col: str = "Achse"):
-    # print(f"Row: {row}")
-
-    possible_links: gpd.GeoDataFrame = (
-        network[network[net_name_col] == row[detect_name_col]][["link_id", "geometry", "node_coord"]]
-        .assign(distance=lambda x: x["geometry"].distance(row["geometry"]))
-        .nsmallest(1, columns="distance", keep="all")
+def closest_links(
+    detectors: gpd.GeoDataFrame,
+    network: gpd.GeoDataFrame,
+    net_name_col: str = "osm:way:name",
+    detect_name_col: str = "Achse",
+) -> pd.Series:
+    """
+    Finds, for every detector, the closest link with the same name as the detector's axis (NA if there is none)
+
+    The detector-link pairs with matching names are all built by a single merge and their distances computed in one vectorized call, instead of filtering the whole network for every detector
+    """
+    # Missing names are dropped on both sides, as merge would otherwise pair detectors without an axis with unnamed links
+    pairs = (
+        pd.DataFrame(
+            {
+                "detector": range(len(detectors)),
+                "name": detectors[detect_name_col].to_numpy(),
+                "detector_coord": detectors["geometry"].to_numpy(),
+                "direction_coord": detectors["direction_coord"].to_numpy(),
+            }
+        )
+        .dropna(subset=["name"])
+        .merge(
+            pd.DataFrame(
+                {
+                    "name": network[net_name_col].to_numpy(),
+                    "link_id": network["link_id"].to_numpy(),
+                    "geometry": network["geometry"].to_numpy(),
+                    "node_coord": network["node_coord"].to_numpy(),
+                }
+            ).dropna(subset=["name"]),
+            on="name",
+        )
     )
-    if len(possible_links) == 1:
-        # Nothing else we need to do
-        pass
-    elif len(possible_links) == 2:
-        # We have superimposed links (due to the street being bi-directional)
-        print(type(possible_links))
-        possible_links = (
-            possible_links.set_geometry("node_coord")
-            .assign(node_to_direction=lambda x: x.distance(row["direction_coord"]))
-            .nsmallest(1, columns="node_to_direction", keep="first")
+    pairs["distance"] = shp.distance(pairs["detector_coord"].to_numpy(), pairs["geometry"].to_numpy())
+
+    closest = pairs[pairs["distance"] == pairs.groupby("detector")["distance"].transform("min")]
+    n_closest = closest.groupby("detector")["link_id"].transform("size")
+    # One closest link needs nothing else, two are superimposed links (due to the street being bi-directional) told apart by which one's node is closer to the direction. More shouldn't be possible and gives NA
+    closest = closest[n_closest <= 2]
+    closest = (
+        closest.assign(
+            node_to_direction=shp.distance(closest["node_coord"].to_numpy(), closest["direction_coord"].to_numpy())
         )
-    else:
-        # This shouldn't be possible
-        row["link_id"] = pd.NA
-        return row
-        # raise Exception('Reconsider your assumptions')
-    row["link_id"] = possible_links.iloc[0]["link_id"]
-    return row
+        .sort_values(by=["detector", "node_to_direction"], kind="stable")
+        .drop_duplicates(subset="detector")
+    )
+
+    link_id = closest.set_index("detector")["link_id"].reindex(range(len(detectors)))
+    return pd.Series(link_id.to_numpy(), index=detectors.index, name="link_id")
 
 
 # Create detector dataframe with detector and direction geometries ##############
@@ -72,8 +103,7 @@ def create_full_network_from_shapefiles(nodes: gpd.GeoDataFrame, links: gpd.GeoD
         )
     )
 
-    print(network)
-    print(type(network))
+    logging.debug("Network: %d links", len(network))
     return gpd.GeoDataFrame(network)
 
 
@@ -95,14 +125,15 @@ def create_full_network_from_matsim(network: matsim.Network, filter_link_col: st
 def merge_links_with_attributes(net: matsim.Network) -> gpd.GeoDataFrame:
     links = net.as_geo().set_crs(epsg=2056)
     link_attrs = net.link_attrs.pivot(index="link_id", columns="name", values="value")
-    assert set(links["link_id"].to_list()) == set(link_attrs.index.to_list())
+    # Same set of link ids on both sides, checked with isin instead of building Python sets over every link
+    assert links["link_id"].isin(link_attrs.index).all() and link_attrs.index.isin(links["link_id"]).all()
     return links.merge(link_attrs, on="link_id")
 
 
 def merge_links_with_nodes(links: pd.DataFrame, nodes: pd.DataFrame) -> gpd.GeoDataFrame:
     links_nodes = gpd.GeoDataFrame(
         links.merge(nodes, left_on="to_node", right_on="node_id")
-        .assign(node_coord=lambda x: shp.points(x["x"], x["y"]))
+        .assign(node_coord=lambda x: shp.points(x["x"].to_numpy(dtype=float), x["y"].to_numpy(dtype=float)))
         .drop(columns=["x", "y"])
     )
 
@@ -122,19 +153,17 @@ def merge_links_with_nodes(links: pd.DataFrame, nodes: pd.DataFrame) -> gpd.GeoD
 def cli(
     detectors_filename, network_filename, direction_col, geocoded_directions_filename, filter_link_col, output_filename
 ):
-    detectors = gpd.read_file(detectors_filename)
-    detectors.set_crs(epsg=2056)
+    detectors = gpd.read_file(detectors_filename).set_crs(epsg=2056)
 
     try:
         geocoded = gpd.read_file(geocoded_directions_filename).set_crs(epsg=4326)
-    except DriverError:
-        directions = detectors[[direction_col]].drop_duplicates()[
-            ~detectors[direction_col].drop_duplicates().isin(["auswärts", "einwärts"])
-        ]
-        print(directions)
+    except DataSourceError:
+        directions = detectors[direction_col].drop_duplicates()
+        directions = directions[~directions.isin(RELATIVE_DIRECTIONS)].to_frame()
+        logging.debug("Directions to geocode: %d", len(directions))
 
         geocoded = get_coordinates_geopy(directions)
-        print(geocoded)
+        logging.debug("Geocoded directions: %d", len(geocoded))
 
         zurich_hb_location = shp.Point(8.540323, 47.377858)
         geocoded = gpd.GeoDataFrame(
@@ -143,24 +172,26 @@ def cli(
                 ignore_index=True,
             )
         )
-        geocoded.set_geometry("direction_coord").set_crs(epsg=4326).to_file(geocoded_directions_filename)
+        geocoded = geocoded.set_geometry("direction_coord").set_crs(epsg=4326)
+        geocoded.to_file(geocoded_directions_filename)
 
+    # The only reprojection, so the distances computed later are plain planar ones in LV95
     geocoded = geocoded.to_crs(epsg=2056)
 
     detectors = create_full_detectors(detectors, geocoded, direction_col)
-    print(detectors)
+    logging.debug("Detectors: %d rows", len(detectors))
 
     network = matsim.read_network(network_filename)
     full_network = create_full_network(network, filter_link_col)
 
-    associated_detectors = gpd.GeoDataFrame(detectors.apply(closest_link, network=full_network, axis=1)).drop(
+    associated_detectors = gpd.GeoDataFrame(detectors.assign(link_id=closest_links(detectors, full_network))).drop(
         columns=["direction_coord"]
     )
     # associated_detectors.to_file(output_filename)
 
     associated_links = full_network.merge(associated_detectors, how="inner", on="link_id").set_geometry("geometry_x")
     associated_nodes = associated_links.drop(columns=["geometry_y", "geometry_x"]).set_geometry("node_coord")
-    print(associated_links.columns)
+    logging.debug("Associated links columns: %s", list(associated_links.columns))
     associated_links.drop(columns=["geometry_y", "node_coord"]).to_file("link_with_network.shp")
     # associated_nodes.to_file('nodes.shp')
 
@@ -7,29 +7,50 @@ from typing import Literal
 from functools import lru_cache
 from pathlib import Path
 
+import numpy as np
 import geopandas as gpd
 import shapely as shp
 
-from map_matching.classes import Node, Detector, FullInfo, FlowOrientation
+from map_matching.classes import Node, Detector, FullInfo, FlowOrientation, FlowSlots, MatchState
 
 
-def find_closest_links(detector: Detector, links_nodes: gpd.GeoDataFrame, net_name_col: str = "name"):
-    """Finds the links with the same name as the axis listed by the detector and returns them sorted by distance to the detector"""
-    closest_link: gpd.GeoDataFrame = (
-        links_nodes[links_nodes[net_name_col] == detector.axis]
-        .copy()
-        .assign(distance=lambda x: x["geometry"].distance(detector.geometry))
-        .sort_values(by=["distance"])
-    )
+def find_closest_links(
+    detector: Detector, links_nodes: gpd.GeoDataFrame, net_name_col: str = "name", name_index: dict | None = None
+):
+    """
+    Finds the links with the same name as the axis listed by the detector and returns them sorted by distance to the detector
+
+    name_index (see build_name_index) gives the row positions of each name's links, so they are taken directly instead of comparing the whole name column
+    """
+    if name_index is None:
+        name_index = build_name_index(links_nodes, net_name_col)
+    positions, distance = rank_closest_links(detector, links_nodes.geometry.values, name_index)
+    closest_link: gpd.GeoDataFrame = links_nodes.iloc[positions].assign(distance=distance)
 
     return closest_link
 
 
+def rank_closest_links(detector: Detector, geometry: np.ndarray, name_index: dict) -> tuple[np.ndarray, np.ndarray]:
+    """Row positions of the links with the same name as the detector's axis, sorted by distance to the detector, along with those distances"""
+    positions = np.asarray(name_index.get(detector.axis, []), dtype=np.intp)
+    # shapely.distance runs over the raw geometry array in one GEOS call
+    distance = shp.distance(geometry[positions], detector.geometry)
+    # Same (default) sort as DataFrame.sort_values, so ties keep being ranked as before
+    order = np.argsort(distance)
+    return positions[order], distance[order]
+
+
 def get_orientation(nodes: tuple[Node, Node], direction_coord: shp.Point):
     """Determine the orientation of the detector relative to the link based on which of a link's end nodes is closer to the direction coordinate"""
-    distance_from, distance_to = nodes[0].geometry.distance(direction_coord), nodes[1].geometry.distance(
-        direction_coord
+    return orientation_from_distances(
+        nodes[0].geometry.distance(direction_coord),
+        nodes[1].geometry.distance(direction_coord),
+        (nodes[0].ID, nodes[1].ID),
     )
+
+
+def orientation_from_distances(distance_from: float, distance_to: float, node_ids: tuple):
+    """get_orientation for already computed distances (or squared distances) from the link's end nodes to the direction coordinate"""
     if distance_from < distance_to:
         # return nodes[0]
         return FlowOrientation.COUNTER
@@ -37,24 +58,20 @@ def get_orientation(nodes: tuple[Node, Node], direction_coord: shp.Point):
         # return nodes[1]
         return FlowOrientation.ALONG
     else:
-        raise Exception(f"Equal distance to direction for nodes {[node.id for node in nodes]}")
+        raise Exception(f"Equal distance to direction for nodes {list(node_ids)}")
 
 
-def verify_orientation(link, flow_orientation: FlowOrientation):
-    """Verify whether the flow orientation for the detector is permitted in the given link"""
-    if link.at[link.index[0], "oneway"] and flow_orientation is FlowOrientation.COUNTER:
-        return False
-    return True
+def verify_orientation(oneway: np.ndarray, position: int, flow_orientation: FlowOrientation):
+    """Verify whether the flow orientation for the detector is permitted in the link at the given position"""
+    return not (oneway[position] and flow_orientation is FlowOrientation.COUNTER)
 
 
-def no_collision(link, flow_orientation: FlowOrientation):
-    """Check whether a detector has already been assigned to the given link in the given flow orientation"""
-    if link.at[link.index[0], flow_orientation.name] is None:
-        return True
-    return False
+def no_collision(slots: FlowSlots, position: int):
+    """Check whether a detector has already been assigned to the link at the given position in the slots' flow orientation"""
+    return bool(slots.detector[position] == -1)
 
 
-def perform_checks(link, flow_orientation) -> Literal[0, 1, 2]:
+def perform_checks(state: MatchState, position: int, flow_orientation: FlowOrientation) -> Literal[0, 1, 2]:
     """
     Performs direction and collision checks
 
@@ -63,84 +80,183 @@ def perform_checks(link, flow_orientation) -> Literal[0, 1, 2]:
         1 - Correct orientation but with collision
         2 - Correct orientation and no collision
     """
-    return 0 if not verify_orientation(link, flow_orientation) else 1 + int(no_collision(link, flow_orientation))
+    if not verify_orientation(state.oneway, position, flow_orientation):
+        return 0
+    return 1 + int(no_collision(state.slots[flow_orientation], position))
 
 
 def resolve_collision(
-    network: gpd.GeoDataFrame, link, detector: Detector, flow_orientation: FlowOrientation, degree: int
-) -> tuple[gpd.GeoDataFrame, bool]:
-    """If previously assigned detector is farther from link than current detector, assign current detector to link and reassign previous detector to new link"""
-    assigned_full_info: FullInfo = network.at[link.index[0], flow_orientation.name]
-
-    logging.debug(f"Assigned distance: {assigned_full_info.distance}")
-    logging.debug(f"Link distance: {link.at[link.index[0], 'distance']}")
-
-    if assigned_full_info.distance > link.at[link.index[0], "distance"]:
-        network = assign_detector_to_link(detector, network, link, degree, flow_orientation)
-        network = find_proper_link(assigned_full_info.detector, network, assigned_full_info.degree + 1)
-        collision = False
-    else:
-        collision = True
+    state: MatchState, position: int, distance: float, detector: int, flow_orientation: FlowOrientation, degree: int
+) -> tuple[int, int] | None:
+    """
+    If previously assigned detector is farther from link than current detector, assign current detector to link
 
-    return network, collision
+    Returns the previous detector and the degree its search for a new link resumes from, or None if the current detector lost
+    """
+    slots = state.slots[flow_orientation]
+    assigned_detector, assigned_distance, assigned_degree = (
+        int(slots.detector[position]),
+        slots.distance[position],
+        int(slots.degree[position]),
+    )
+
+    logging.debug(f"Assigned distance: {assigned_distance}")
+    logging.debug(f"Link distance: {distance}")
+
+    if assigned_distance > distance:
+        assign_detector_to_link(state, position, distance, detector, degree, flow_orientation)
+        return assigned_detector, assigned_degree + 1
+    return None
 
 
 def assign_detector_to_link(
-    detector, network, link, degree: int, flow_orientation: FlowOrientation
-) -> gpd.GeoDataFrame:
-    network.at[link.index[0], flow_orientation.name] = FullInfo(detector, link.at[link.index[0], "distance"], degree)
-    return network
+    state: MatchState, position: int, distance: float, detector: int, degree: int, flow_orientation: FlowOrientation
+):
+    slots = state.slots[flow_orientation]
+    slots.detector[position], slots.distance[position], slots.degree[position] = detector, distance, degree
+
 
+def point_xy(points: np.ndarray) -> np.ndarray:
+    """(n, 2) array of the points' coordinates, NaN for missing points"""
+    return np.column_stack([shp.get_x(points), shp.get_y(points)])
 
-def find_proper_link(detector: Detector, network: gpd.GeoDataFrame, degree: int) -> gpd.GeoDataFrame:
-    collision = True
-    closest_links = find_closest_links(detector, network)
 
-    while collision:
+def squared_distance(xy: np.ndarray, other_xy: np.ndarray) -> np.ndarray:
+    """Squared planar distance between (broadcastable) arrays of coordinates, enough to tell which point is closer"""
+    return ((xy - other_xy) ** 2).sum(axis=-1)
+
+
+def detector_candidates(state: MatchState, detector: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Ranked candidate links of the detector (see rank_closest_links) and the squared distances from their end nodes to the detector's direction coordinate
+
+    Computed once per detector and kept in state.candidates, as evicted detectors come back for the same ranking (iterate fills it up front with rank_candidates_by_axis)
+    """
+    if detector not in state.candidates:
+        detector_info = state.detectors[detector]
+        positions, distances = rank_closest_links(detector_info, state.geometry, state.name_index)
+        # The end nodes of every candidate are measured against the direction coordinate at once, retries only index into them
+        direction = point_xy(np.array([detector_info.direction_coordinates], dtype=object))[0]
+        from_direction = squared_distance(state.from_xy[positions], direction)
+        to_direction = squared_distance(state.to_xy[positions], direction)
+        state.candidates[detector] = positions, distances, from_direction, to_direction
+    return state.candidates[detector]
+
+
+def rank_candidates_by_axis(state: MatchState, detectors: gpd.GeoDataFrame):
+    """
+    Fill state.candidates (see detector_candidates) for every detector with an axis
+
+    Detectors on the same axis share their candidate links, so each axis takes one (detectors x links) batch of distance calls instead of one per detector
+    """
+    geometry = np.asarray(detectors.geometry.values, dtype=object)
+    direction = point_xy(np.asarray(detectors["direction_coordinates"], dtype=object))
+    for axis, rows in detectors.groupby("axis", sort=False).indices.items():
+        positions = np.asarray(state.name_index.get(axis, []), dtype=np.intp)
+        distances = shp.distance(state.geometry[positions][np.newaxis, :], geometry[rows][:, np.newaxis])
+        # Row-wise, this is the same sort rank_closest_links does
+        order = np.argsort(distances, axis=1)
+        from_direction = squared_distance(state.from_xy[positions][np.newaxis], direction[rows][:, np.newaxis])
+        to_direction = squared_distance(state.to_xy[positions][np.newaxis], direction[rows][:, np.newaxis])
+        for i, row in enumerate(rows):
+            state.candidates[int(row)] = (
+                positions[order[i]],
+                distances[i, order[i]],
+                from_direction[i, order[i]],
+                to_direction[i, order[i]],
+            )
+
+
+def find_proper_link(state: MatchState, detector: int, degree: int):
+    """Assign the detector (given by its position in state.detectors) to a link, then reassign whichever detector that evicts, and so on"""
+    # A loop rather than recursion through resolve_collision, so long eviction chains cannot hit the recursion limit
+    evicted = detector, degree
+    while evicted is not None:
+        evicted = place_detector(state, *evicted)
+
+
+def place_detector(state: MatchState, detector: int, degree: int) -> tuple[int, int] | None:
+    """Assign the detector to its degree-th closest link or, failing the checks, a farther one. Returns the detector it evicted, if any"""
+    detector_info = state.detectors[detector]
+    positions, distances, from_direction, to_direction = detector_candidates(state, detector)
+
+    while True:
         # Attempt to get the next closest link (with the correct name)
-        try:
-            nth_closest_link = closest_links.iloc[[degree]]
-        except IndexError:
-            logging.warning(f"Ran out of links for assignment of detector {detector}")
-            return network
-
-        flow_orientation = get_orientation(
-            (
-                nth_closest_link.at[nth_closest_link.index[0], "node_from"],
-                nth_closest_link.at[nth_closest_link.index[0], "node_to"],
-            ),
-            detector.direction_coordinates,
+        if degree >= len(positions):
+            logging.warning(f"Ran out of links for assignment of detector {detector_info}")
+            return None
+        position, distance = positions[degree], distances[degree]
+
+        flow_orientation = orientation_from_distances(
+            from_direction[degree], to_direction[degree], (state.from_id[position], state.to_id[position])
         )
 
-        match pc := perform_checks(nth_closest_link, flow_orientation):
+        pc = perform_checks(state, position, flow_orientation)
+        logging.debug(f"Case was {pc}")
+        match pc:
             case 0:
                 # Mismatched orientation
                 degree += 1
             case 1:
                 # Correct orientation but with collision
-                network, collision = resolve_collision(network, nth_closest_link, detector, flow_orientation, degree)
+                evicted = resolve_collision(state, position, distance, detector, flow_orientation, degree)
+                if evicted is not None:
+                    return evicted
                 degree += 1
             case 2:
                 # Correct orientation and no collision
-                network = assign_detector_to_link(detector, network, nth_closest_link, degree, flow_orientation)
-                collision = False
+                assign_detector_to_link(state, position, distance, detector, degree, flow_orientation)
+                return None
             case _:
                 raise Exception(f"Serious problem with perform_checks method (returned {pc})")
-        logging.debug(f"Case was {pc}")
-    return network
+
+
+def build_name_index(links_nodes: gpd.GeoDataFrame, net_name_col: str = "name") -> dict:
+    """Maps every link name to the row positions of the links with that name"""
+    return links_nodes.groupby(net_name_col, sort=False).indices
+
+
+def prep_state(detectors: gpd.GeoDataFrame, network: gpd.GeoDataFrame) -> MatchState:
+    """Pull the columns read during matching out of the network, with no detector assigned yet"""
+    return MatchState(
+        detectors=list(detectors.itertuples()),
+        geometry=np.asarray(network.geometry.values, dtype=object),
+        # Same truthiness as the column's values (e.g. None or 0 for two-way links), as a plain bool array
+        oneway=network["oneway"].to_numpy().astype(bool),
+        from_id=np.array([node.ID for node in network["node_from"]]),
+        to_id=np.array([node.ID for node in network["node_to"]]),
+        from_xy=point_xy(np.array([node.geometry for node in network["node_from"]], dtype=object)),
+        to_xy=point_xy(np.array([node.geometry for node in network["node_to"]], dtype=object)),
+        name_index=build_name_index(network),
+        slots={flow: FlowSlots.empty(len(network)) for flow in FlowOrientation},
+        candidates={},
+    )
+
+
+def slots_to_full_info(state: MatchState, flow_orientation: FlowOrientation) -> list[FullInfo | None]:
+    slots = state.slots[flow_orientation]
+    return [
+        None if detector == -1 else FullInfo(state.detectors[detector], float(distance), int(degree))
+        for detector, distance, degree in zip(slots.detector, slots.distance, slots.degree)
+    ]
 
 
 def iterate(detectors: gpd.GeoDataFrame, network: gpd.GeoDataFrame):
+    """
+    Assign every detector to a link and return the network with the FullInfo of each assignment in its flow columns
+
+    Matching starts from no assignments and keeps its state in MatchState arrays, the flow columns (added or replaced) are only built once it is done
+    """
     # Yes, we will be iterating over a dataframe's rows.
     # Yes, this is an anti-pattern.
-    # However, the detector df is small (less than a thousand rows) and we rely on recursion for matching
-    n = 1
-    for detector in detectors.itertuples():
-        logging.info("Starting detector %d: %s" % (n, detector))
+    # However, the detector df is small (less than a thousand rows) and every detector may evict others along the way
+    state = prep_state(detectors, network)
+    rank_candidates_by_axis(state, detectors)
+    for n, detector in enumerate(state.detectors):
+        logging.info("Starting detector %d: %s" % (n + 1, detector))
         degree = 0
-        network = find_proper_link(detector, network, degree)
-        n += 1
-    return network
+        find_proper_link(state, n, degree)
+    return network.assign(**{flow.name: slots_to_full_info(state, flow) for flow in FlowOrientation})
 
 
 # Sanity check methods ###################
@@ -149,18 +265,12 @@ def iterate(detectors: gpd.GeoDataFrame, network: gpd.GeoDataFrame):
 def perform_sanity_checks(network: gpd.GeoDataFrame):
     # Check that links which are oneway only have a detector assigned in the 'along' column and None in the 'counter' column
     # Check that, for each link, there is at most one assigned detector for each flow orientation
-    return only_along_oneway(network) and one_per_flow(network)
-
-
-def only_along_oneway(network: gpd.GeoDataFrame) -> bool:
-    return network[network["oneway"] == 1].unique_values().to_list() == [None]
-
-
-def one_per_flow(network: gpd.GeoDataFrame) -> bool:
-    return (
-        network[FlowOrientation.ALONG.name].map(type).apply(lambda x: isinstance(x, (FullInfo, None))).all()
-        and network[FlowOrientation.COUNTER.name].map(type).apply(lambda x: isinstance(x, (FullInfo, None))).all()
-    )
+    # Both checks share a single null mask over the flow columns
+    flows = network[[flow.name for flow in FlowOrientation]]
+    assigned = flows.notna()
+    only_along_oneway = not (assigned[FlowOrientation.COUNTER.name] & (network["oneway"] == 1)).any()
+    one_per_flow = (~assigned | flows.map(lambda info: info.__class__ is FullInfo)).to_numpy().all()
+    return bool(only_along_oneway and one_per_flow)
 
 
 # OSM net methods ###################
@@ -175,15 +285,17 @@ def get_osm_net(place: str):
 
 def prep_network(nodes: gpd.GeoDataFrame, links: gpd.GeoDataFrame, from_crs="WGS84", to_crs="LV95") -> gpd.GeoDataFrame:
     """Properly setup the network so it can be used in the algorithm"""
-    nodes["node"] = nodes.to_crs(to_crs).apply(lambda x: Node(x.name, x.geometry), axis=1)
-    links = (
-        links.to_crs(to_crs)[~links["name"].isna()][["name", "oneway", "geometry", "osmid"]]
-        .merge(nodes["node"], left_on="u", right_index=True)
-        .merge(nodes["node"], left_on="v", right_index=True, suffixes=["_from", "_to"])
-    )  # \
-    # .droplevel('key')
-    links[FlowOrientation.ALONG.name] = None
-    links[FlowOrientation.COUNTER.name] = None
+    # Only the geometry is reprojected, and the Node objects are built from plain arrays rather than a row-wise apply
+    nodes["node"] = [Node(osmid, point) for osmid, point in zip(nodes.index, nodes.geometry.to_crs(to_crs).values)]
+    # Unnamed links are dropped before (rather than after) reprojecting every coordinate
+    links = links[~links["name"].isna()][["name", "oneway", "geometry", "osmid"]].to_crs(to_crs)
+    # The end nodes are gathered by position instead of two merges, dropping links with a missing node like the (inner) merges did
+    node_from = nodes.index.get_indexer(links.index.get_level_values("u"))
+    node_to = nodes.index.get_indexer(links.index.get_level_values("v"))
+    found = (node_from != -1) & (node_to != -1)
+    node_objects = nodes["node"].to_numpy()
+    links = links[found].assign(node_from=node_objects[node_from[found]], node_to=node_objects[node_to[found]])
+    # The ALONG/COUNTER flow columns are added by iterate, once the matching is done
 
     return links
 
@@ -1,48 +1,54 @@
 import pytest
 
 import pandas as pd
-from pandas.testing import assert_frame_equal
+from pandas.testing import assert_frame_equal, assert_series_equal
 import numpy as np
+import geopandas as gpd
+import shapely as shp
+from enum import member
+from functools import partial
+from pathlib import Path
 
 from diagnostic import analyses
 
-@pytest.fixture
-def link_comparison_df() -> pd.DataFrame:
-    comp_dict = {
-        'link_id' : [i for i in range(1, 4)],
-        'count_obs' : [i for i in range(0, 3)],
-        'count_sim' : [i for i in range(1, 4)]
-    }
+# Fixtures that tests only read are built once per module, those tests must not modify them
 
-    return pd.DataFrame.from_dict(comp_dict)
+@pytest.fixture(scope='module')
+def link_comparison_df() -> pd.DataFrame:
+    return pd.DataFrame({
+        'link_id' : np.arange(1, 4),
+        'count_obs' : np.arange(0, 3),
+        'count_sim' : np.arange(1, 4)
+    })
 
 ##### Test CountComparisonOptions #####
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def count_comparison_options() -> analyses.CountComparisonOptions:
     return analyses.CountComparisonOptions
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def complete_link_comparison_df(link_comparison_df, count_comparison_options):
-    link_comparison_df[count_comparison_options.DIFF.name] = pd.Series([1 - 0, 2 - 1, 3 - 2])
-    link_comparison_df[count_comparison_options.RATIO.name] = pd.Series([np.inf, 2/1, 3/2])
-    link_comparison_df[count_comparison_options.GEH.name] = pd.Series([np.sqrt(2*(1 - 0)**2/(1 + 0)), np.sqrt(2*(2 - 1)**2/(2 + 1)), np.sqrt(2*(3 - 2)**2/(3 + 2))])
-    link_comparison_df[count_comparison_options.SQV.name] = pd.Series([0, 1/(1 + np.sqrt((2 - 1)**2/1000)), 1/(1 + np.sqrt((3 - 2)**2/2000))])
-
-    return link_comparison_df
+    # Columns in the options' order, which is the order CountComparison adds them in
+    return link_comparison_df.assign(**{
+        count_comparison_options.DIFF.name: pd.Series([1 - 0, 2 - 1, 3 - 2]),
+        count_comparison_options.RATIO.name: pd.Series([np.inf, 2/1, 3/2]),
+        count_comparison_options.SQV.name: pd.Series([0, 1/(1 + np.sqrt((2 - 1)**2/1000)), 1/(1 + np.sqrt((3 - 2)**2/2000))]),
+        count_comparison_options.GEH.name: pd.Series([np.sqrt(2*(1 - 0)**2/(1 + 0)), np.sqrt(2*(2 - 1)**2/(2 + 1)), np.sqrt(2*(3 - 2)**2/(3 + 2))])
+    })
 
 class TestCountComparisonOptions:
     def test_count_comparison_options_diff(self, count_comparison_options: analyses.CountComparisonOptions, link_comparison_df: pd.DataFrame, complete_link_comparison_df):
-        assert count_comparison_options.DIFF.value(link_comparison_df).equals(complete_link_comparison_df.DIFF)
+        assert_series_equal(count_comparison_options.DIFF.value(link_comparison_df), complete_link_comparison_df.DIFF, check_names=False, check_exact=True)
 
     def test_count_comparison_options_ratio(self, count_comparison_options: analyses.CountComparisonOptions, link_comparison_df: pd.DataFrame, complete_link_comparison_df):
-        assert count_comparison_options.RATIO.value(link_comparison_df).equals(complete_link_comparison_df.RATIO)
+        assert_series_equal(count_comparison_options.RATIO.value(link_comparison_df), complete_link_comparison_df.RATIO, check_names=False, check_exact=True)
 
     def test_count_comparison_options_geh(self, count_comparison_options: analyses.CountComparisonOptions, link_comparison_df: pd.DataFrame, complete_link_comparison_df):
-        assert count_comparison_options.GEH.value(link_comparison_df).equals(complete_link_comparison_df.GEH)
+        assert_series_equal(count_comparison_options.GEH.value(link_comparison_df), complete_link_comparison_df.GEH, check_names=False, check_exact=True)
 
     def test_count_comparison_options_sqv(self, count_comparison_options: analyses.CountComparisonOptions, link_comparison_df: pd.DataFrame, complete_link_comparison_df):
-        assert count_comparison_options.SQV.value(link_comparison_df).equals(complete_link_comparison_df.SQV)
+        assert_series_equal(count_comparison_options.SQV.value(link_comparison_df), complete_link_comparison_df.SQV, check_names=False, check_exact=True)
 
 ##### Test CountComparison analysis #####
 
@@ -52,15 +58,56 @@ def count_comparison_analysis(link_comparison_df) -> analyses.CountComparison:
 
 def test_count_comparison_analysis(count_comparison_analysis, link_comparison_df, complete_link_comparison_df):
     count_comparison_analysis.generate_analysis(link_comparison_df)
-    assert_frame_equal(count_comparison_analysis.result, complete_link_comparison_df)
+    assert_frame_equal(count_comparison_analysis.result, complete_link_comparison_df.round(2))
+
+def test_count_comparison_analysis_keeps_input(count_comparison_analysis):
+    comparison = pd.DataFrame({'link_id': [1, 2], 'count_obs': [1, 2], 'count_sim': [2, 3]})
+    count_comparison_analysis.generate_analysis(comparison)
+    assert list(comparison.columns) == ['link_id', 'count_obs', 'count_sim']
+
+def test_count_comparison_analysis_custom_options():
+    # User Options get the whole comparison as a DataFrame, including the columns of the options before them
+    class CustomOptions(analyses.Options):
+        ABS_DIFF = member(lambda comp: (comp['count_sim'] - comp['count_obs']).abs())
+        LINK_DIFF = member(lambda comp: comp['link_id'] * comp['ABS_DIFF'])
+
+    comparison = pd.DataFrame({'link_id': [1, 2], 'count_obs': [3, 2], 'count_sim': [2, 3]})
+    analysis = analyses.CountComparison(options=CustomOptions)
+    analysis.generate_analysis(comparison)
+    assert_frame_equal(analysis.result, comparison.assign(ABS_DIFF=[1, 1], LINK_DIFF=[1, 2]))
+
+def test_count_comparison_analysis_rounds_after_options():
+    # Options using earlier ones get their unrounded values, only the result is rounded
+    class CustomOptions(analyses.Options):
+        RATIO = member(lambda comp: comp['count_sim'] / comp['count_obs'])
+        SCALED_RATIO = member(lambda comp: comp['RATIO'] * 1000)
+
+    comparison = pd.DataFrame({'link_id': [1, 2], 'count_obs': [3, 7], 'count_sim': [2, 3]})
+    analysis = analyses.CountComparison(options=CustomOptions)
+    analysis.generate_analysis(comparison)
+    assert_frame_equal(analysis.result, comparison.assign(RATIO=[0.67, 0.43], SCALED_RATIO=[666.67, 428.57]))
+
+##### Test FilterByValue #####
+
+def test_filter_by_value_single_rule(link_comparison_df):
+    result = analyses.FilterByValue({'link_id': [1, 3]}).apply_filter(link_comparison_df)
+    assert_frame_equal(result, link_comparison_df.iloc[[0, 2]])
+
+def test_filter_by_value_multiple_rules(link_comparison_df):
+    result = analyses.FilterByValue({'link_id': [1, 2, 3], 'count_obs': [1, 2], 'count_sim': [2]}).apply_filter(link_comparison_df)
+    assert_frame_equal(result, link_comparison_df.iloc[[1]])
+
+def test_filter_by_value_composite_rule(link_comparison_df):
+    result = analyses.FilterByValue({('link_id', 'count_obs'): [(1, 0), (3, 1), (3, 2)]}).apply_filter(link_comparison_df)
+    assert_frame_equal(result, link_comparison_df.iloc[[0, 2]])
 
 ##### Test CountSummaryStatsOptions #####
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def count_summary_stats_options():
     return analyses.CountSummaryStatsOptions
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def count_summary_stats_result(count_summary_stats_options):
     result_dict = {
         count_summary_stats_options.MIN.name: [0, 1],
@@ -70,30 +117,31 @@ def count_summary_stats_result(count_summary_stats_options):
         count_summary_stats_options.QUARTILE_3.name: [1.5, 2.5],
         count_summary_stats_options.MAX.name: [2, 3]
     }
-    return pd.DataFrame.from_dict(result_dict, columns=['count_obs', 'count_sim'], orient='index', dtype='float64')
+    return pd.DataFrame(list(result_dict.values()), index=list(result_dict), columns=['count_obs', 'count_sim'], dtype='float64')
+
+@pytest.fixture(scope='module')
+def summary_columns():
+    return ['count_obs', 'count_sim']
 
-@pytest.mark.parametrize(
-    "column", ['count_sim', 'count_obs']
-)
 class TestCountSummaryStatsOptions:
 
-    def test_css_option_min(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, column):
-        assert count_summary_stats_options.MIN.value(link_comparison_df[column]) == count_summary_stats_result.loc['MIN', column]
+    def test_css_option_min(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, summary_columns):
+        np.testing.assert_array_equal([count_summary_stats_options.MIN.value(link_comparison_df[column]) for column in summary_columns], count_summary_stats_result.loc['MIN', summary_columns].to_numpy())
 
-    def test_css_option_quartile_1(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, column):
-        assert count_summary_stats_options.QUARTILE_1.value(link_comparison_df[column]) == count_summary_stats_result.loc['QUARTILE_1', column]
+    def test_css_option_quartile_1(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, summary_columns):
+        np.testing.assert_array_equal([count_summary_stats_options.QUARTILE_1.value(link_comparison_df[column]) for column in summary_columns], count_summary_stats_result.loc['QUARTILE_1', summary_columns].to_numpy())
 
-    def test_css_option_median(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, column):
-        assert count_summary_stats_options.MEDIAN.value(link_comparison_df[column]) == count_summary_stats_result.loc['MEDIAN', column]
+    def test_css_option_median(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, summary_columns):
+        np.testing.assert_array_equal([count_summary_stats_options.MEDIAN.value(link_comparison_df[column]) for column in summary_columns], count_summary_stats_result.loc['MEDIAN', summary_columns].to_numpy())
 
-    def test_css_option_mean(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, column):
-        assert count_summary_stats_options.MEAN.value(link_comparison_df[column]) == count_summary_stats_result.loc['MEAN', column]
+    def test_css_option_mean(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, summary_columns):
+        np.testing.assert_array_equal([count_summary_stats_options.MEAN.value(link_comparison_df[column]) for column in summary_columns], count_summary_stats_result.loc['MEAN', summary_columns].to_numpy())
 
-    def test_css_option_quartile_3(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, column):
-        assert count_summary_stats_options.QUARTILE_3.value(link_comparison_df[column]) == count_summary_stats_result.loc['QUARTILE_3', column]
+    def test_css_option_quartile_3(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, summary_columns):
+        np.testing.assert_array_equal([count_summary_stats_options.QUARTILE_3.value(link_comparison_df[column]) for column in summary_columns], count_summary_stats_result.loc['QUARTILE_3', summary_columns].to_numpy())
 
-    def test_css_option_max(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, column):
-        assert count_summary_stats_options.MAX.value(link_comparison_df[column]) == count_summary_stats_result.loc['MAX', column ]
+    def test_css_option_max(self, count_summary_stats_options, link_comparison_df, count_summary_stats_result, summary_columns):
+        np.testing.assert_array_equal([count_summary_stats_options.MAX.value(link_comparison_df[column]) for column in summary_columns], count_summary_stats_result.loc['MAX', summary_columns].to_numpy())
 
 ##### Test CountSummaryStats #####
 
@@ -103,4 +151,124 @@ def count_summary_stats_analysis():
 
 def test_count_summary_stats(count_summary_stats_analysis, link_comparison_df, count_summary_stats_result):
     count_summary_stats_analysis.generate_analysis(link_comparison_df)
-    assert_frame_equal(count_summary_stats_analysis.result, count_summary_stats_result)
\ No newline at end of file
+    assert_frame_equal(count_summary_stats_analysis.result, count_summary_stats_result)
+
+def test_count_summary_stats_large_counts(count_summary_stats_analysis, count_summary_stats_options):
+    # Whole counts close to 2**24, whose stats can't be represented in float32
+    comparison = pd.DataFrame({
+        'link_id': np.arange(100),
+        'count_obs': [10016, 10017] * 50,
+        'count_sim': [8386922] * 86 + [8386923] * 14
+    })
+    count_summary_stats_analysis.generate_analysis(comparison)
+    expected = pd.DataFrame(
+        [[10016, 8386922], [10016, 8386922], [10016.5, 8386922], [10016.5, 8386922.14], [10017, 8386922], [10017, 8386923]],
+        index=[stat.name for stat in count_summary_stats_options], columns=['count_obs', 'count_sim'], dtype='float64'
+    )
+    assert_frame_equal(count_summary_stats_analysis.result, expected, check_exact=True)
+
+##### Test CountVisualization #####
+
+@pytest.fixture(scope='module')
+def visualization_comparison_gdf() -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(
+        {'count_obs': [1.0, 2.0, 3.0], 'count_sim': [2.0, 2.0, 1.0]},
+        geometry=[shp.LineString([(i, 0), (i + 1, 1)]) for i in range(3)]
+    )
+
+def assert_plots_saved(paths, directory, extension):
+    assert [Path(path).name for path in paths] == [f'count_obs.{extension}', f'count_sim.{extension}']
+    for path in paths:
+        assert Path(path).parent == Path(directory)
+        assert Path(path).is_file()
+
+def test_count_visualization_generate_analysis(visualization_comparison_gdf, tmp_path):
+    visualization = analyses.CountVisualization()
+    visualization.generate_analysis(visualization_comparison_gdf, directory=tmp_path, extension='png')
+    assert_plots_saved(visualization.result.values(), tmp_path, 'png')
+
+def test_count_visualization_reuses_temp_directory(visualization_comparison_gdf):
+    visualization = analyses.CountVisualization()
+    visualization.generate_analysis(visualization_comparison_gdf)
+    first = list(visualization.result.values())
+    visualization.generate_analysis(visualization_comparison_gdf)
+    assert list(visualization.result.values()) == first
+    assert_plots_saved(first, first[0].parent, 'pdf')
+
+@pytest.mark.parametrize('extension', [None, 'pdf', 'png'])
+def test_count_visualization_to_file(visualization_comparison_gdf, tmp_path, extension):
+    visualization = analyses.CountVisualization()
+    visualization.generate_analysis(visualization_comparison_gdf)
+    paths = visualization.to_file(directory=tmp_path, extension=extension)
+    assert_plots_saved(paths, tmp_path, extension or 'pdf')
+
+def test_count_visualization_to_file_same_directory(visualization_comparison_gdf, tmp_path):
+    visualization = analyses.CountVisualization()
+    visualization.generate_analysis(visualization_comparison_gdf, directory=tmp_path)
+    assert_plots_saved(visualization.to_file(directory=tmp_path), tmp_path, 'pdf')
+
+def test_count_visualization_to_file_keeps_rendered_plots(visualization_comparison_gdf, tmp_path):
+    visualization = analyses.CountVisualization()
+    visualization.generate_analysis(visualization_comparison_gdf)
+    paths = visualization.to_file(directory=tmp_path, extension='png')
+    assert list(visualization.result.values()) == paths
+    assert visualization.to_file(extension='png') == paths
+
+##### Test EarthMoverDistance #####
+
+@pytest.fixture
+def emd_comparison_df() -> pd.DataFrame:
+    comp_dict = {
+        'link_id' : [1, 1, 1, 2, 2],
+        'time' : [0, 20, 40, 0, 40],
+        'count_sim' : [1, 1, 2, 3, 1],
+        'count_obs' : [1, 0, 3, 1, 1]
+    }
+
+    return pd.DataFrame.from_dict(comp_dict)
+
+@pytest.fixture
+def emd_result() -> pd.DataFrame:
+    result_dict = {
+        'link_id' : [1, 2],
+        'EMD15' : [0.5, 0.5],
+        'EMD30' : [0.5, 0.5],
+        'EMD60' : [0.0, 0.0]
+    }
+
+    return pd.DataFrame.from_dict(result_dict)
+
+def test_earth_mover_distance(emd_comparison_df, emd_result):
+    emd = analyses.EarthMoverDistance()
+    emd.generate_analysis(emd_comparison_df)
+    assert_frame_equal(emd.result, emd_result)
+
+def test_earth_mover_distance_custom_options(emd_comparison_df, emd_result):
+    # Options without an interval_duration are called on the comparison as they are
+    class CustomOptions(analyses.Options):
+        EMD20 = member(partial(analyses.EMDOptions._emd_grouping, interval_duration=20))
+        EMD120 = member(lambda comp: analyses.EMDOptions._emd_grouping(comp, 120))
+
+    emd = analyses.EarthMoverDistance(options=CustomOptions)
+    emd.generate_analysis(emd_comparison_df)
+    assert_frame_equal(emd.result, emd_result[['link_id']].assign(EMD20=[0.5, 0.5], EMD120=[0.0, 0.0]))
+
+def test_earth_mover_distance_no_options(emd_comparison_df, emd_result):
+    class NoOptions(analyses.Options):
+        pass
+
+    emd = analyses.EarthMoverDistance(options=NoOptions)
+    emd.generate_analysis(emd_comparison_df)
+    assert_frame_equal(emd.result, emd_result[['link_id']])
+
+def test_earth_mover_distance_missing_link_id(emd_comparison_df, emd_result):
+    # Rows without a link_id are left out, like a groupby on link_id would
+    comparison = pd.concat([emd_comparison_df, pd.DataFrame({'link_id': [np.nan], 'time': [0], 'count_sim': [1], 'count_obs': [2]})], ignore_index=True)
+    emd = analyses.EarthMoverDistance()
+    emd.generate_analysis(comparison)
+    assert_frame_equal(emd.result, emd_result.astype({'link_id': 'float64'}))
+
+def test_earth_mover_distance_filter_by_link(emd_comparison_df, emd_result):
+    emd = analyses.EarthMoverDistance(analyses.FilterByValue({'link_id': [2], 'EMD30': [0.5]}))
+    emd.generate_analysis(emd_comparison_df)
+    assert_frame_equal(emd.result, emd_result.iloc[[1]])
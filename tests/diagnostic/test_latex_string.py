@@ -0,0 +1,53 @@
+import pytest
+
+import pandas as pd
+import numpy as np
+
+from pylatex import Figure
+from pylatex.utils import NoEscape, dumps_list
+
+from diagnostic.latex_string import LatexString, FigureContainer, longtable, table
+
+@pytest.fixture
+def table_df() -> pd.DataFrame:
+    table_dict = {
+        'count_sim' : [1, 2, 3],
+        'RATIO' : [np.inf, 2/1, 3/2],
+        'GEH' : [np.sqrt(2), np.nan, -0.004]
+    }
+
+    return pd.DataFrame.from_dict(table_dict).set_index(pd.Index([3, 1, 2], name='link_id'))
+
+def test_longtable_matches_styler(table_df):
+    styler = table_df.style
+    styler.format(escape='latex', precision=2)
+    expected = styler.to_latex(caption='Caption', position='H', label='table:label', environment='longtable')
+
+    assert longtable(table_df, caption='Caption', label='table:label') == expected
+
+def test_table_matches_styler(table_df):
+    styler = table_df.style
+    styler.format(escape='latex', precision=2)
+    expected = styler.to_latex(caption='Caption', position='H', label='table:label', position_float='centering')
+
+    assert table(table_df, caption='Caption', label='table:label') == expected
+
+def test_latex_string_escape():
+    assert LatexString('a_b&c_', ['_', '&']).dumps() == r'a\_b\&c\_'
+
+def test_latex_string_escape_sequence():
+    assert LatexString('a__b&c', ['__', '&']).dumps() == r'a\__b\&c'
+
+def test_latex_string_escape_consistent():
+    # The single chars are escaped the same whether or not a longer sequence is escaped too
+    assert LatexString('a_b', ['_', '\\']).dumps() == r'a\_b'
+    assert LatexString('a_b', ['_', '\\', '&&']).dumps() == r'a\_b'
+    assert LatexString('a_b&&c&d', ['&', '&&', '_']).dumps() == r'a\_b\&&c\&d'
+
+def test_figure_container_matches_pylatex():
+    paths = ['plots/count_sim.pdf', 'plots/GEH.v1.pdf']
+    figures = [Figure(position='H') for path in paths]
+    for fig, path in zip(figures, paths):
+        fig.add_image(path, width=NoEscape(r'\textwidth'))
+
+    assert FigureContainer(paths).dumps() == dumps_list(figures)
@@ -0,0 +1,34 @@
+import pytest
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+import numpy as np
+
+from diagnostic.report import CreateComparisonDF
+
+@pytest.fixture
+def counts_df() -> pd.DataFrame:
+    counts_dict = {
+        'link_id' : [3, 1, 3, np.nan, 1, 2],
+        'time' : [0, 900, 0, 0, 0, 900],
+        'count' : [1, 2, 3, 4, np.nan, 6]
+    }
+
+    return pd.DataFrame.from_dict(counts_dict)
+
+##### Test CreateComparisonDF #####
+
+@pytest.mark.parametrize('keys', [['link_id'], ['link_id', 'time']])
+def test_sum_counts_matches_groupby(counts_df, keys):
+    expected = counts_df.groupby(keys)['count'].sum().reset_index()
+    assert_frame_equal(CreateComparisonDF._sum_counts(counts_df, keys), expected)
+
+def test_emd_comparison(counts_df):
+    observed = pd.DataFrame({'link_id': [1, 4], 'time': [900, 0], 'count': [5, 7]})
+    expected = pd.DataFrame({
+        'link_id' : [1.0, 1.0, 2.0, 3.0, 4.0],
+        'time' : [0, 900, 900, 0, 0],
+        'count_sim' : [0.0, 2.0, 6.0, 4.0, 0.0],
+        'count_obs' : [0, 5, 0, 0, 7]
+    })
+    assert_frame_equal(CreateComparisonDF.emd(counts_df, observed), expected)
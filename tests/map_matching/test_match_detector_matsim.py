@@ -0,0 +1,41 @@
+import pytest
+
+import shapely as shp
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+
+pytest.importorskip('matsim')
+
+from map_matching.match_detector_matsim import closest_links
+
+# Closest links ######################
+
+@pytest.fixture
+def matsim_network():
+    # Two superimposed links on 'street_name' plus an unnamed link right next to the detectors
+    return gpd.GeoDataFrame({
+        'osm:way:name': ['street_name', 'street_name', np.nan],
+        'link_id': ['a', 'b', 'c'],
+        'node_coord': shp.points([10, 0, 0], [0, 0, 1]),
+        'geometry': [shp.LineString([(0, 0), (10, 0)]), shp.LineString([(10, 0), (0, 0)]), shp.LineString([(0, 1), (10, 1)])]
+    })
+
+def test_closest_links(matsim_network):
+    detectors = gpd.GeoDataFrame({
+        'Achse': ['street_name', 'street_name'],
+        'direction_coord': shp.points([20, -10], [0, 0]),
+        'geometry': shp.points([5, 5], [0.5, 0.5])
+    }, index=[3, 7])
+    assert closest_links(detectors, matsim_network).to_list() == ['a', 'b']
+
+def test_closest_links_missing_axis(matsim_network):
+    # A detector without an axis must not be matched to the unnamed link
+    detectors = gpd.GeoDataFrame({
+        'Achse': [np.nan, 'street_name'],
+        'direction_coord': shp.points([20, 20], [0, 0]),
+        'geometry': shp.points([5, 5], [1, 1])
+    })
+    result = closest_links(detectors, matsim_network)
+    assert pd.isna(result.iloc[0])
+    assert result.iloc[1] == 'a'
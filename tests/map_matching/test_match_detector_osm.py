@@ -3,9 +3,10 @@ import pytest
 import shapely as shp
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 
 from map_matching.classes import *
-from map_matching.match_detector_osm import find_closest_links, get_orientation, verify_orientation, no_collision
+from map_matching.match_detector_osm import find_closest_links, build_name_index, get_orientation, verify_orientation, no_collision, iterate, perform_sanity_checks, prep_state, rank_candidates_by_axis, detector_candidates
 
 # Nodes #############################
 
@@ -13,7 +14,7 @@ from map_matching.match_detector_osm import find_closest_links, get_orientation,
 def nodes_df():
     # Dataframe with 4 nodes in a T shape
     return gpd.GeoDataFrame({
-        "node": [Node(i, shp.Point(x, 0)) for i, x in zip(range(3), (0, 5, 10))] + [Node(3, shp.Point(5, -10))]
+        "node": [Node(i, point) for i, point in enumerate(shp.points([0, 5, 10, 5], [0, 0, 0, -10]))]
     }, index = pd.Index(range(4), name = 'osmid'))
 
 @pytest.fixture
@@ -50,26 +51,27 @@ def links_gdf():
         "oneway": [1] * 2 + [0],
         FlowOrientation.COUNTER.name: [None] * 3,
         FlowOrientation.ALONG.name: [None] * 3,
-        "geometry": [shp.LineString([(x, 0), (x + 5, 0)]) for x in (0, 5)] + [shp.LineString([(5, 0), (5, -2)])]
+        "geometry": shp.linestrings([[(0, 0), (5, 0)], [(5, 0), (10, 0)], [(5, 0), (5, -2)]])
     }, index = pd.MultiIndex.from_arrays([[0, 1, 1], [1, 2, 3]], names = ["u", "v"]))
 
 # Links_nodes ##########################
 
 @pytest.fixture
 def links_nodes_gdf(links_gdf, nodes_df):
-    return links_gdf\
-        .merge(nodes_df["node"], left_on="u", right_index=True)\
-        .merge(nodes_df["node"], left_on="v", right_index=True, suffixes=["_from", "_to"])
+    return links_gdf.assign(
+        node_from=links_gdf.index.get_level_values("u").map(nodes_df["node"]),
+        node_to=links_gdf.index.get_level_values("v").map(nodes_df["node"])
+    )
 
 # Detectors ###################################
 
 @pytest.fixture
 def detector_gdf():
     return gpd.GeoDataFrame({
-        "id": range(3),
-        "geometry": [shp.Point(x, 0) for x in (2, 7)] + [shp.Point(5, -5)],
+        "id": np.arange(3),
+        "geometry": shp.points([2, 7, 5], [0, 0, -5]),
         "axis": ["street_name"] * 2 + ["other_street"],
-        "direction_coordinates": [shp.Point(x, y) for x, y in ((20, 0), (20, 0), (5, -20))]
+        "direction_coordinates": shp.points([20, 20, 5], [0, 0, -20])
     })
 
 @pytest.fixture
@@ -84,41 +86,68 @@ def test_find_closest_links(detector: Detector, links_nodes_gdf: gpd.GeoDataFram
 
     assert find.equals(manual)
 
+def test_find_closest_links_name_index(detector: Detector, links_nodes_gdf: gpd.GeoDataFrame):
+    name_index = build_name_index(links_nodes_gdf)
+    assert find_closest_links(detector, links_nodes_gdf, name_index=name_index).equals(find_closest_links(detector, links_nodes_gdf))
+
 def test_get_orientation(node_tuple, detector):
     direction_coordinates = detector.direction_coordinates
     assert get_orientation(node_tuple, direction_coordinates) == FlowOrientation.ALONG
 
 #### Verify orientation
 
-def test_verify_orientation_oneway_along(oneway_link):
-    assert verify_orientation(oneway_link, FlowOrientation.ALONG)
-
-def test_verify_orientation_oneway_counter(oneway_link):
-    assert not verify_orientation(oneway_link, FlowOrientation.COUNTER)
-
-def test_verify_orientation_twoway_along(twoway_link):
-    assert verify_orientation(twoway_link, FlowOrientation.ALONG)
-
-def test_verify_orientation_twoway_counter(twoway_link):
-    assert verify_orientation(twoway_link, FlowOrientation.COUNTER)
+@pytest.mark.parametrize(
+    "link_fixture, flow_orientation, expected", [
+        ('oneway_link', FlowOrientation.ALONG, True),
+        ('oneway_link', FlowOrientation.COUNTER, False),
+        ('twoway_link', FlowOrientation.ALONG, True),
+        ('twoway_link', FlowOrientation.COUNTER, True)
+    ]
+)
+def test_verify_orientation(request, link_fixture, flow_orientation, expected):
+    link = request.getfixturevalue(link_fixture)
+    assert verify_orientation(link['oneway'].to_numpy(), 0, flow_orientation) is expected
 
 #### Collision detection
 
-def test_no_collision_oneway(oneway_link):
-    assert no_collision(oneway_link, FlowOrientation.ALONG)
-
-def test_collision_oneway(oneway_link, detector):
-    oneway_link.loc[:, FlowOrientation.ALONG.name] = detector
-    assert not no_collision(oneway_link, FlowOrientation.ALONG)
-
-def test_collision_twoway_counter(twoway_link, detector):
-    twoway_link.loc[:, FlowOrientation.COUNTER.name] = detector
-    assert not no_collision(twoway_link, FlowOrientation.COUNTER)
-
-def test_collision_twoway_along(twoway_link, detector):
-    twoway_link.loc[:, FlowOrientation.ALONG.name] = detector
-    assert not no_collision(twoway_link, FlowOrientation.ALONG)
-
-def test_no_collision_twoway_along_counter(twoway_link, detector):
-    twoway_link.loc[:, FlowOrientation.ALONG.name] = detector
-    assert no_collision(twoway_link, FlowOrientation.COUNTER)
\ No newline at end of file
+@pytest.fixture
+def slots(links_gdf):
+    return {flow: FlowSlots.empty(len(links_gdf)) for flow in FlowOrientation}
+
+@pytest.mark.parametrize(
+    "assigned, checked, expected", [
+        (None, (FlowOrientation.ALONG, 0), True),
+        ((FlowOrientation.ALONG, 0), (FlowOrientation.ALONG, 0), False),
+        ((FlowOrientation.COUNTER, 2), (FlowOrientation.COUNTER, 2), False),
+        ((FlowOrientation.ALONG, 0), (FlowOrientation.ALONG, 1), True),
+        ((FlowOrientation.ALONG, 2), (FlowOrientation.COUNTER, 2), True)
+    ]
+)
+def test_no_collision(slots, assigned, checked, expected):
+    # Slots are given as (flow orientation, link position)
+    if assigned is not None:
+        slots[assigned[0]].detector[assigned[1]] = 0
+    assert no_collision(slots[checked[0]], checked[1]) is expected
+
+#### Matching
+
+def test_rank_candidates_by_axis(detector_gdf, links_nodes_gdf):
+    batched = prep_state(detector_gdf, links_nodes_gdf)
+    rank_candidates_by_axis(batched, detector_gdf)
+    single = prep_state(detector_gdf, links_nodes_gdf)
+    for n in range(len(detector_gdf)):
+        for a, b in zip(batched.candidates[n], detector_candidates(single, n)):
+            np.testing.assert_array_equal(a, b)
+
+def test_iterate(detector_gdf, links_nodes_gdf):
+    matched = iterate(detector_gdf, links_nodes_gdf)
+    assert [info.detector.id for info in matched[FlowOrientation.ALONG.name]] == [0, 1, 2]
+    assert matched[FlowOrientation.COUNTER.name].isna().all()
+
+def test_sanity_checks(detector_gdf, links_nodes_gdf):
+    assert perform_sanity_checks(iterate(detector_gdf, links_nodes_gdf))
+
+def test_sanity_checks_counter_on_oneway(detector_gdf, links_nodes_gdf):
+    matched = iterate(detector_gdf, links_nodes_gdf)
+    matched.iloc[0, matched.columns.get_loc(FlowOrientation.COUNTER.name)] = matched.iloc[1][FlowOrientation.ALONG.name]
+    assert not perform_sanity_checks(matched)